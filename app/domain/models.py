@@ -1,7 +1,7 @@
 from datetime import datetime, UTC
 from typing import Optional
 from sqlmodel import SQLModel, Field, Relationship
-from sqlalchemy import Column, JSON
+from sqlalchemy import Column, Index, JSON
 from pydantic import BaseModel
 
 
@@ -25,10 +25,20 @@ class Email(SQLModel, table=True):
 
 
 class ProcessedEmail(SQLModel, table=True):
+    __table_args__ = (
+        Index(
+            "ix_processedemail_benchmark_id_processed_at",
+            "benchmark_id",
+            "processed_at",
+        ),
+    )
+
     id: int = Field(default=None, primary_key=True)
     email_id: str = Field(foreign_key="email.filename")
     email: Optional[Email] = Relationship(back_populates="processed_emails")
-    benchmark_id: int | None = Field(default=None, foreign_key="llmbenchmark.id")
+    benchmark_id: int | None = Field(
+        default=None, foreign_key="llmbenchmark.id", index=True
+    )
     benchmark: Optional["LLMBenchmark"] = Relationship(
         back_populates="processed_emails"
     )
@@ -37,6 +47,9 @@ class ProcessedEmail(SQLModel, table=True):
     created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
     processed_at: datetime | None = Field(default=None)
+    # Work queue claim: the worker holding this entry and when its lease lapses
+    worker_id: str | None = Field(default=None)
+    lease_expires_at: datetime | None = Field(default=None)
 
 
 class LLMBenchmark(SQLModel, table=True):
@@ -45,6 +58,8 @@ class LLMBenchmark(SQLModel, table=True):
     model: str = Field(default="")
     subset: str = Field(default="")
     system_prompt: str = Field(default="")
+    # Results processed up to this time are already in the exported files
+    export_watermark: datetime | None = Field(default=None)
     created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
     processed_emails: list["ProcessedEmail"] = Relationship(back_populates="benchmark")
@@ -58,3 +73,17 @@ class StockHistory(SQLModel, table=True):
     volume: float = Field(default=0.0)
     created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
+
+
+class BenchmarkPeriodStat(SQLModel, table=True):
+    """Per-period stock discussion counts for a benchmark, cached for analysis."""
+
+    id: int = Field(default=None, primary_key=True)
+    benchmark_id: int = Field(foreign_key="llmbenchmark.id", index=True)
+    period: str = Field(default="DAY")
+    period_start: datetime = Field(nullable=False)
+    emails: int = Field(default=0)
+    stock_emails: int = Field(default=0)
+    # Latest processed_at counted when the cache was built
+    built_through: datetime | None = Field(default=None)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
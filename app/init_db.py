@@ -10,6 +10,16 @@ DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:postgres@db:5432
 
 engine = create_engine(DATABASE_URL, echo=True)
 
+# create_all only creates missing tables, so columns and indexes added to
+# existing tables are applied here to upgrade an older database in place
+UPGRADE_STATEMENTS = [
+    "ALTER TABLE processedemail ADD COLUMN IF NOT EXISTS worker_id VARCHAR",
+    "ALTER TABLE processedemail ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP WITHOUT TIME ZONE",
+    "CREATE INDEX IF NOT EXISTS ix_processedemail_benchmark_id ON processedemail (benchmark_id)",
+    "CREATE INDEX IF NOT EXISTS ix_processedemail_benchmark_id_processed_at ON processedemail (benchmark_id, processed_at)",
+    "ALTER TABLE llmbenchmark ADD COLUMN IF NOT EXISTS export_watermark TIMESTAMP WITHOUT TIME ZONE",
+]
+
 
 def init_db(drop_all=False):
     """Initialize the database, creating all tables if they don't exist."""
@@ -25,6 +35,12 @@ def init_db(drop_all=False):
     if drop_all:
         SQLModel.metadata.drop_all(engine)
     SQLModel.metadata.create_all(engine)
+
+    print("Upgrading existing tables...")
+    with engine.connect() as conn:
+        for statement in UPGRADE_STATEMENTS:
+            conn.execute(text(statement))
+        conn.commit()
     print("Database initialization completed!")
 
 
@@ -1,13 +1,15 @@
 from enum import Enum
 import json
 import shutil
+import socket
+import time
 import zipfile
-from sqlalchemy import func, delete
+from sqlalchemy import func, delete, insert, literal, update
 import typer
 from pathlib import Path
 from util.fileparser import parse_email_file
 from rich.prompt import Prompt, IntPrompt
-from rich.progress import track
+from rich.progress import Progress, track
 from rich.panel import Panel
 from rich.text import Text
 from sqlmodel import create_engine, Session
@@ -16,6 +18,16 @@ from util.db import (
     processed_email_count,
     stock_history_count,
     llm_benchmark_count,
+    benchmark_progress,
+)
+from util.queue import Heartbeat, claim_batch, hold_entry, release_leases
+from util.analysis import (
+    ANALYSIS_PERIODS,
+    event_windows,
+    join_prices,
+    lagged_correlations,
+    period_stats,
+    price_frame,
 )
 
 from init_db import init_db
@@ -28,12 +40,13 @@ from domain.models import (
     BenchmarkSummary,
 )
 from sqlmodel import select, and_
-from datetime import datetime, UTC
+from datetime import datetime, timedelta
 from rich import print
 from util.tgi import check_health, check_ollama
 from typing_extensions import Annotated
 from dotenv import load_dotenv
 import os
+import pandas as pd
 
 from ollama import ChatResponse, Client, Options
 
@@ -42,6 +55,8 @@ load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 MODEL_ID = os.getenv("MODEL_ID")
 CONTEXT_SIZE = os.getenv("CONTEXT_SIZE")
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://host.docker.internal:11434")
+EXPORT_GRACE_SECONDS = 30
 engine = create_engine(DATABASE_URL)
 
 DEFAULT_SYSTEM_PROMPT = "You are an investigator for the SEC. You specialize in securities fraud. Your job is analyzing emails to determine their nature and whether or not they are discussing stocks, the stock market, stock tickers, stock prices, etc. You will provide a brief (1 sentence) summary of the email's subject matter and flag your best evaluation of whether the email is discussing stocks, stock prices, etc. Your summary should be brief and to the point, without any preamble or conclusion."
@@ -207,8 +222,12 @@ def new_benchmark(
         print(f"Benchmark created with id {benchmark.id}")
         print(f"Fetching emails for benchmark")
 
+        # Only filenames are selected: the subset is copied into the work queue
+        # inside Postgres and bodies are fetched per batch by the workers
         if per == BenchmarkPeriod.ALL or num <= 0:
-            query = select(Email).where(Email.date.is_not(None))
+            query = select(Email.filename, literal(benchmark.id)).where(
+                Email.date.is_not(None)
+            )
         else:
             if per == BenchmarkPeriod.HOUR:
                 partition_by = (
@@ -240,7 +259,7 @@ def new_benchmark(
                 .subquery("sq")
             )
 
-            query = select(Email).join(
+            query = select(Email.filename, literal(benchmark.id)).join(
                 subq, and_(subq.c.row_number <= num, Email.filename == subq.c.filename)
             )
 
@@ -260,66 +279,231 @@ def new_benchmark(
             elif dow == BenchmarkDOW.SATURDAY:
                 query = query.where(func.date_part("dow", Email.date) == 6)
 
-        emails = session.exec(query).all()
+        print(f"Creating benchmark entries")
+        result = session.exec(
+            insert(ProcessedEmail).from_select(
+                ["email_id", "benchmark_id"], query.order_by(Email.date)
+            )
+        )
+        benchmark_id = benchmark.id
+        session.commit()
 
         print(
-            f"Found {len(emails)} emails in subset ({num} per {str(per)} ({str(dow)}))"
+            f"Found {result.rowcount} emails in subset ({num} per {str(per)} ({str(dow)}))"
         )
-        print(f"Creating benchmark entries for {len(emails)} emails")
-        for email in track(emails, description="Creating benchmark entries"):
 
-            benchmark_entry = ProcessedEmail(
-                email_id=email.filename,
-                benchmark_id=benchmark.id,
+    print(
+        f"Additional workers can join with: python main.py benchmark-worker --id {benchmark_id} --host <ollama url>"
+    )
+    run_worker(benchmark_id)
+
+
+def summarize_email(
+    client: Client, benchmark: LLMBenchmark, email_id: str, body: str
+) -> BenchmarkSummary:
+    print(f"Processing email {email_id}")
+    response: ChatResponse = client.chat(
+        model=benchmark.model,
+        messages=[
+            {
+                "role": "system",
+                "content": benchmark.system_prompt,
+            },
+            {
+                "role": "user",
+                "content": f"Analyze the following email: `{body}`",
+                # and respond in this format: {BenchmarkSummary.model_json_schema()}",
+            },
+        ],
+        format=BenchmarkSummary.model_json_schema(),
+        options=Options(num_ctx=CONTEXT_SIZE),
+    )
+    summary = BenchmarkSummary.model_validate_json(response["message"]["content"])
+
+    print(
+        f"[{'red' if summary.is_discussing_stocks else 'cyan'}] {summary.summary}[/{'red' if summary.is_discussing_stocks else 'cyan'}]"
+    )
+    return summary
+
+
+def run_worker(
+    benchmark_id: int,
+    host: str = OLLAMA_HOST,
+    batch_size: int = 10,
+    lease_seconds: int = 600,
+    poll_seconds: int = 30,
+    max_attempts: int = 5,
+    timeout_seconds: int = 600,
+):
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    # A hung endpoint times out and counts as a failed attempt, so a stuck
+    # worker gives up and stops its heartbeat rather than holding its leases
+    client = Client(host=host, timeout=timeout_seconds)
+
+    heartbeat = Heartbeat(engine, worker_id, lease_seconds)
+    heartbeat.start()
+    print(f"Worker {worker_id} processing benchmark {benchmark_id} with {host}")
+
+    try:
+        # Results are written with UPDATE statements, so nothing held by the
+        # session needs reloading after each commit
+        with (
+            Session(engine, expire_on_commit=False) as session,
+            Progress() as progress,
+        ):
+            benchmark = session.exec(
+                select(LLMBenchmark).where(LLMBenchmark.id == benchmark_id)
+            ).one()
+            processed, total, workers = benchmark_progress(benchmark_id)
+            task = progress.add_task(
+                f"Processing emails ({workers} workers)",
+                total=total,
+                completed=processed,
             )
-            client = Client(host="http://host.docker.internal:11434")
-            chat = client.chat
-
-            done = False
-            while not done:
-                print(f"Processing email {email.filename}")
-                try:
-                    response: ChatResponse = chat(
-                        model=MODEL_ID,
-                        messages=[
-                            {
-                                "role": "system",
-                                "content": benchmark.system_prompt,
-                            },
-                            {
-                                "role": "user",
-                                "content": f"Analyze the following email: `{email.body}`",
-                                # and respond in this format: {BenchmarkSummary.model_json_schema()}",
-                            },
-                        ],
-                        format=BenchmarkSummary.model_json_schema(),
-                        options=Options(num_ctx=CONTEXT_SIZE),
+
+            while True:
+                entries = claim_batch(
+                    session, benchmark_id, worker_id, batch_size, lease_seconds
+                )
+                if not entries:
+                    processed, total, workers = benchmark_progress(benchmark_id)
+                    progress.update(
+                        task,
+                        completed=processed,
+                        description=f"Processing emails ({workers} workers)",
                     )
-                    summary = BenchmarkSummary.model_validate_json(
-                        response["message"]["content"]
+                    if processed >= total:
+                        break
+                    # Remaining entries are leased by other workers; wait in case
+                    # one of them stops making progress and its lease expires
+                    time.sleep(poll_seconds)
+                    continue
+
+                # Bodies for the whole batch in one round trip, just ahead of
+                # dispatch; each one is dropped as soon as it has been sent
+                bodies = dict(
+                    session.exec(
+                        select(Email.filename, Email.body).where(
+                            Email.filename.in_([entry.email_id for entry in entries])
+                        )
+                    ).all()
+                )
+                # End the read transaction so no snapshot is held open during
+                # the LLM calls (commit, unlike rollback, leaves benchmark loaded)
+                session.commit()
+
+                for entry in entries:
+                    body = bodies.pop(entry.email_id)
+                    if not hold_entry(session, entry.id, worker_id, lease_seconds):
+                        print(f"Lease on email {entry.email_id} lost, skipping")
+                        continue
+                    for attempt in range(1, max_attempts + 1):
+                        try:
+                            summary = summarize_email(
+                                client, benchmark, entry.email_id, body
+                            )
+                            break
+                        except Exception as e:
+                            print(f"Error processing email {entry.email_id}: {e}")
+                            if attempt == max_attempts:
+                                print(
+                                    f"Giving up after {max_attempts} attempts, releasing claimed emails"
+                                )
+                                raise typer.Exit(code=1)
+                            print(f"Retrying...")
+                    # Only written while this worker still holds the entry, so a
+                    # result never replaces one from a worker that reclaimed it
+                    result = session.exec(
+                        update(ProcessedEmail)
+                        .where(
+                            ProcessedEmail.id == entry.id,
+                            ProcessedEmail.worker_id == worker_id,
+                            ProcessedEmail.processed_at.is_(None),
+                        )
+                        .values(
+                            summary=summary.summary,
+                            stock_mentions=summary.is_discussing_stocks,
+                            # Database clock, so export watermarks are consistent
+                            # across workers on different hosts. clock_timestamp,
+                            # unlike now(), is the time of the update itself rather
+                            # than of the start of its transaction
+                            processed_at=func.clock_timestamp(),
+                        )
                     )
-                    benchmark_entry.summary = summary.summary
-                    benchmark_entry.stock_mentions = summary.is_discussing_stocks
-                    benchmark_entry.processed_at = datetime.now(UTC)
+                    session.commit()
+                    if result.rowcount == 0:
+                        print(f"Lease on email {entry.email_id} lost, result dropped")
+                        continue
+                    progress.advance(task)
+
+                # Sync with the work done by every other worker since the last batch
+                processed, total, workers = benchmark_progress(benchmark_id)
+                progress.update(
+                    task,
+                    completed=processed,
+                    description=f"Processing emails ({workers} workers)",
+                )
+    finally:
+        heartbeat.stop()
+        with Session(engine) as session:
+            release_leases(session, worker_id)
 
-                    print(
-                        f"[{'red' if benchmark_entry.stock_mentions else 'cyan'}] {benchmark_entry.summary}[/{'red' if benchmark_entry.stock_mentions else 'cyan'}]"
-                    )
+    print(f"Benchmark {benchmark_id} complete ({processed} of {total} emails)")
 
-                    session.add(benchmark_entry)
-                    session.commit()
-                    done = True
-                except Exception as e:
-                    print(f"Error processing email {email.filename}: {e}")
-                    print(f"Retrying...")
-                    done = False
 
-        session.commit()
+@app.command()
+def benchmark_worker(
+    benchmark_id: Annotated[int, typer.Option("--id", prompt="Benchmark ID")] = None,
+    host: Annotated[
+        str, typer.Option("--host", help="Ollama endpoint used by this worker")
+    ] = OLLAMA_HOST,
+    batch_size: Annotated[
+        int, typer.Option("--batch-size", help="Emails claimed per batch", min=1)
+    ] = 10,
+    lease_seconds: Annotated[
+        int,
+        typer.Option("--lease", help="Seconds before unfinished claims expire", min=1),
+    ] = 600,
+    max_attempts: Annotated[
+        int,
+        typer.Option(
+            "--max-attempts", help="Attempts per email before giving up", min=1
+        ),
+    ] = 5,
+    timeout_seconds: Annotated[
+        int,
+        typer.Option("--timeout", help="Seconds before an LLM call fails", min=1),
+    ] = 600,
+):
+    if not benchmark_id:
+        with Session(engine) as session:
+            benchmarks = session.exec(select(LLMBenchmark)).all()
+            for benchmark in benchmarks:
+                print(
+                    f"[cyan][b]{benchmark.id}:[/b] {benchmark.name} - {benchmark.model} - ({benchmark.subset})[/cyan]"
+                )
+            benchmark_id = IntPrompt.ask(
+                "Benchmark ID",
+                choices=[str(benchmark.id) for benchmark in benchmarks],
+            )
+
+    run_worker(
+        benchmark_id,
+        host=host,
+        batch_size=batch_size,
+        lease_seconds=lease_seconds,
+        max_attempts=max_attempts,
+        timeout_seconds=timeout_seconds,
+    )
 
 
 @app.command()
 def export_benchmark(
     benchmark_id: Annotated[int, typer.Option("--id", prompt="Benchmark ID")] = None,
+    full: Annotated[
+        bool,
+        typer.Option("--full", help="Rebuild the export instead of appending to it"),
+    ] = False,
 ):
     with Session(engine) as session:
         if not benchmark_id:
@@ -337,31 +521,79 @@ def export_benchmark(
             select(LLMBenchmark).where(LLMBenchmark.id == benchmark_id)
         ).one()
 
+        benchmark_dir = f"/results/{benchmark.id}_{benchmark.model}"
+        csv_path = f"{benchmark_dir}/benchmark.csv"
+        zip_path = f"{benchmark_dir}/emails.zip"
+
+        # Append to the previous export unless asked not to or it is missing
+        full = (
+            full
+            or benchmark.export_watermark is None
+            or not os.path.exists(csv_path)
+            or not os.path.exists(zip_path)
+        )
+
         print(
-            f"Exporting benchmark {benchmark.id} - {benchmark.name} - {benchmark.model} - ({benchmark.subset})"
+            f"Exporting benchmark {benchmark.id} - {benchmark.name} - {benchmark.model} - ({benchmark.subset}) ({'full' if full else 'incremental'})"
         )
 
-        benchmark_entries = session.exec(
-            select(ProcessedEmail).where(ProcessedEmail.benchmark_id == benchmark_id)
-        ).all()
+        # Stop a little short of now so results still being committed by a
+        # worker are left for the next export instead of being skipped
+        watermark = session.exec(
+            select(func.localtimestamp() - timedelta(seconds=EXPORT_GRACE_SECONDS))
+        ).one()
 
-        benchmark_entries.sort(key=lambda x: x.email.date)
+        query = select(ProcessedEmail).where(
+            ProcessedEmail.benchmark_id == benchmark_id,
+            ProcessedEmail.processed_at.is_not(None),
+            ProcessedEmail.processed_at <= watermark,
+        )
+        if not full:
+            query = query.where(
+                ProcessedEmail.processed_at > benchmark.export_watermark
+            )
 
-        print(f"Exporting {len(benchmark_entries)} benchmark entries")
+        benchmark_entries = session.exec(query).all()
 
-        benchmark_dir = f"/results/{benchmark.id}_{benchmark.model}"
+        benchmark_entries.sort(key=lambda x: x.email.date)
 
-        os.makedirs(f"{benchmark_dir}/emails", exist_ok=True)
+        print(
+            f"Exporting {len(benchmark_entries)} {'' if full else 'new '}benchmark entries"
+        )
 
-        with open(f"{benchmark_dir}/benchmark_info.json", "w") as f:
-            json.dump(benchmark.model_dump_json(), f)
+        os.makedirs(benchmark_dir, exist_ok=True)
 
-        with open(f"{benchmark_dir}/benchmark.csv", "w") as f:
+        # Rows go to a side file and are only added to benchmark.csv once the
+        # archive is written, right before the watermark is moved, so a failed
+        # export does not leave rows that the next one would append again. A
+        # full rebuild writes a new archive alongside the old one as well.
+        new_csv_path = f"{csv_path}.new"
+        new_zip_path = f"{zip_path}.new" if full else zip_path
+
+        with (
+            open(new_csv_path, "w") as f,
+            zipfile.ZipFile(new_zip_path, "w" if full else "a") as zipf,
+        ):
             writer = csv.writer(f)
-            writer.writerow(
-                ["sender", "recipients", "date", "summary", "price", "stock_discussion"]
-            )
+            if full:
+                writer.writerow(
+                    [
+                        "sender",
+                        "recipients",
+                        "date",
+                        "summary",
+                        "price",
+                        "stock_discussion",
+                    ]
+                )
+            archived = set(zipf.namelist())
+
             for benchmark_entry in benchmark_entries:
+                # Emails already in the archive were exported before; skip them
+                # should their processed_at have moved past the watermark
+                if not full and benchmark_entry.email_id in archived:
+                    continue
+
                 stock_price = session.exec(
                     select(StockHistory)
                     .where(StockHistory.date <= benchmark_entry.email.date)
@@ -388,15 +620,24 @@ def export_benchmark(
                 )
 
                 file_name = benchmark_entry.email.filename
-                file_path = f"{benchmark_dir}/emails/{file_name}"
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                shutil.copy(f"/email-data/maildir/{file_name}", file_path)
+                if file_name not in archived:
+                    zipf.write(f"/email-data/maildir/{file_name}", file_name)
+                    archived.add(file_name)
+
+        if full:
+            os.replace(new_zip_path, zip_path)
+            os.replace(new_csv_path, csv_path)
+        else:
+            with open(new_csv_path, "r") as new_rows, open(csv_path, "a") as f:
+                shutil.copyfileobj(new_rows, f)
+            os.remove(new_csv_path)
 
-            # Zip the emails, then delete the directory
-            with zipfile.ZipFile(f"{benchmark_dir}/emails.zip", "w") as zipf:
-                for file in Path(f"{benchmark_dir}/emails").glob("**/*"):
-                    zipf.write(file, file.relative_to(Path(f"{benchmark_dir}/emails")))
-            shutil.rmtree(f"{benchmark_dir}/emails")
+        benchmark.export_watermark = watermark
+        session.add(benchmark)
+        session.commit()
+
+        with open(f"{benchmark_dir}/benchmark_info.json", "w") as f:
+            json.dump(benchmark.model_dump_json(), f)
 
         print(
             f"Exported benchmark {benchmark.id} - {benchmark.name} - {benchmark.model} - ({benchmark.subset}) to {benchmark_dir}"
@@ -437,7 +678,8 @@ def compare_benchmarks(
 
         processed_emails = session.exec(
             select(ProcessedEmail).where(
-                ProcessedEmail.benchmark_id.in_([benchmark_id_1, benchmark_id_2])
+                ProcessedEmail.benchmark_id.in_([benchmark_id_1, benchmark_id_2]),
+                ProcessedEmail.processed_at.is_not(None),
             )
         ).all()
 
@@ -500,6 +742,117 @@ def compare_benchmarks(
             print("No disagreements found")
 
 
+@app.command()
+def analyze_benchmark(
+    benchmark_ids: Annotated[
+        list[int], typer.Option("--id", help="Benchmark ID (repeat to compare)")
+    ] = None,
+    max_lag: Annotated[
+        int, typer.Option("--max-lag", help="Periods of lead/lag to correlate", min=0)
+    ] = 10,
+    volatility_window: Annotated[
+        int,
+        typer.Option(
+            "--volatility-window", help="Periods in rolling volatility", min=2
+        ),
+    ] = 20,
+    event_threshold: Annotated[
+        float,
+        typer.Option("--event-threshold", help="Std devs for a large price move"),
+    ] = 2.0,
+    event_window: Annotated[
+        int, typer.Option("--event-window", help="Periods around each move", min=1)
+    ] = 5,
+    refresh: Annotated[
+        bool, typer.Option("--refresh", help="Rebuild cached period counts")
+    ] = False,
+):
+    if stock_history_count() == 0:
+        print("No stock prices in database, initialize stock prices first (option s)")
+        return
+
+    with Session(engine) as session:
+        if not benchmark_ids:
+            benchmarks = session.exec(select(LLMBenchmark)).all()
+            for benchmark in benchmarks:
+                print(
+                    f"[cyan][b]{benchmark.id}:[/b] {benchmark.name} - {benchmark.model} - ({benchmark.subset})[/cyan]"
+                )
+            benchmark_ids = [
+                int(x)
+                for x in Prompt.ask(
+                    "Benchmark IDs (comma separated)",
+                    default=str(benchmarks[-1].id),
+                ).split(",")
+            ]
+
+        benchmarks = [
+            session.exec(
+                select(LLMBenchmark).where(LLMBenchmark.id == benchmark_id)
+            ).one()
+            for benchmark_id in benchmark_ids
+        ]
+
+        for period in ANALYSIS_PERIODS:
+            prices = price_frame(session, period, volatility_window)
+            rates = {}
+            markets = []
+
+            for benchmark in benchmarks:
+                stats = period_stats(session, benchmark.id, period, refresh=refresh)
+                if stats.empty:
+                    print(f"Benchmark {benchmark.id} has no processed emails")
+                    continue
+
+                frame = join_prices(stats, prices, period)
+                correlations = lagged_correlations(frame, max_lag)
+                events = event_windows(frame, event_threshold, event_window)
+                rates[f"rate_{benchmark.id}_{benchmark.model}"] = frame.set_index(
+                    "period_start"
+                )["rate"]
+                markets.append(frame.set_index("period_start")[["close", "return"]])
+
+                analysis_dir = f"/results/{benchmark.id}_{benchmark.model}/analysis"
+                os.makedirs(analysis_dir, exist_ok=True)
+                frame.to_csv(f"{analysis_dir}/{period.lower()}.csv", index=False)
+                correlations.to_csv(
+                    f"{analysis_dir}/{period.lower()}_correlations.csv", index=False
+                )
+                events.to_csv(
+                    f"{analysis_dir}/{period.lower()}_events.csv", index=False
+                )
+
+                strongest = correlations.loc[
+                    correlations["return"].abs().fillna(0).idxmax()
+                ]
+                before = events[list(range(-event_window, 0))].stack().mean()
+                after = events[list(range(0, event_window + 1))].stack().mean()
+                print(
+                    f"[b]{benchmark.id} - {benchmark.name} ({period}):[/b] "
+                    f"{frame['emails'].sum()} emails over {len(frame)} periods, "
+                    f"mean stock discussion rate {frame['rate'].mean():.3f}"
+                )
+                print(
+                    f"  Strongest rate/return correlation {strongest['return']:.3f} at lag {int(strongest['lag'])}"
+                )
+                print(
+                    f"  {len(events)} large price moves: rate {before:.3f} before, {after:.3f} after"
+                )
+
+            if len(rates) > 1:
+                # Prices as-of joined per benchmark, so periods without trading
+                # keep the last close like the per-benchmark files
+                market = pd.concat(markets).groupby(level=0).first()
+                comparison = (
+                    pd.DataFrame(rates).join(market).rename_axis("period_start")
+                )
+                comparison_path = f"/results/analysis_{'_vs_'.join(str(x) for x in benchmark_ids)}_{period.lower()}.csv"
+                comparison.to_csv(comparison_path)
+                print(f"Comparison written to {comparison_path}")
+
+        print(f"Analysis written to /results/<benchmark>/analysis")
+
+
 @app.command()
 def menu():
     menu_choices = {
@@ -517,15 +870,25 @@ def menu():
         f"{'Re-initialize' if stock_history_count_n > 0 else 'Initialize'} stock price database ({stock_history_count_n} in db)",
     ]
 
-    if check_ollama() and email_count_n > 0:
+    if check_ollama(OLLAMA_HOST) and email_count_n > 0:
         menu_choices["n"] = [new_benchmark, f"Create new benchmark for {MODEL_ID}"]
 
     llm_benchmark_count_n = llm_benchmark_count()
     if llm_benchmark_count_n > 0:
+        if check_ollama(OLLAMA_HOST):
+            menu_choices["w"] = [
+                benchmark_worker,
+                f"Join a benchmark as a worker ({llm_benchmark_count_n} benchmarks)",
+            ]
         menu_choices["b"] = [
             export_benchmark,
             f"Export benchmark results ({llm_benchmark_count_n} benchmarks)",
         ]
+        if stock_history_count_n > 0:
+            menu_choices["a"] = [
+                analyze_benchmark,
+                f"Analyze stock discussion vs. price ({llm_benchmark_count_n} benchmarks)",
+            ]
         if llm_benchmark_count_n > 1:
             menu_choices["c"] = [
                 compare_benchmarks,
@@ -534,7 +897,9 @@ def menu():
 
     menu_choices["x"] = [exit, "Exit"]
 
-    status = "[green]ONLINE[/green]" if check_ollama() else "[red]OFFLINE[/red]"
+    status = (
+        "[green]ONLINE[/green]" if check_ollama(OLLAMA_HOST) else "[red]OFFLINE[/red]"
+    )
 
     panel = Panel(
         "\n".join([f"[b]{key}:[/b] {value[1]}" for key, value in menu_choices.items()]),
@@ -0,0 +1,217 @@
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+from sqlalchemy import DateTime, delete, exists, insert, literal
+from sqlmodel import Session, select, func
+from domain.models import BenchmarkPeriodStat, Email, ProcessedEmail, StockHistory
+
+# date_trunc unit, pandas frequency and periods per year for each analysis period
+ANALYSIS_PERIODS = {
+    "DAY": ("day", "D", 252),
+    "WEEK": ("week", "W-MON", 52),
+}
+
+# Results processed in the last few seconds are left out of a cache build, as
+# a worker may have stamped processed_at but not yet committed it
+CACHE_GRACE_SECONDS = 30
+
+# Market series correlated against the stock discussion rate
+MARKET_COLUMNS = ["return", "abs_return", "range", "volume_change", "volatility"]
+
+
+def period_stats(
+    session: Session, benchmark_id: int, period: str, refresh: bool = False
+) -> pd.DataFrame:
+    """Stock discussion counts per period for a benchmark.
+
+    Counts are aggregated in Postgres and cached in BenchmarkPeriodStat along
+    with the processed_at cutoff they include. The cache is rebuilt only when an
+    index lookup finds a result processed after that (or on refresh), so repeated
+    analyses never re-scan ProcessedEmail.
+    """
+    built_through = session.exec(
+        select(func.max(BenchmarkPeriodStat.built_through)).where(
+            BenchmarkPeriodStat.benchmark_id == benchmark_id,
+            BenchmarkPeriodStat.period == period,
+        )
+    ).one()
+    stale = (
+        built_through is None
+        or session.exec(
+            select(
+                exists().where(
+                    ProcessedEmail.benchmark_id == benchmark_id,
+                    ProcessedEmail.processed_at > built_through,
+                )
+            )
+        ).one()
+    )
+
+    if refresh or stale:
+        session.exec(
+            delete(BenchmarkPeriodStat).where(
+                BenchmarkPeriodStat.benchmark_id == benchmark_id,
+                BenchmarkPeriodStat.period == period,
+            )
+        )
+        cutoff = session.exec(
+            select(func.localtimestamp() - timedelta(seconds=CACHE_GRACE_SECONDS))
+        ).one()
+        period_start = func.date_trunc(ANALYSIS_PERIODS[period][0], Email.date)
+        session.exec(
+            insert(BenchmarkPeriodStat).from_select(
+                [
+                    "benchmark_id",
+                    "period",
+                    "period_start",
+                    "emails",
+                    "stock_emails",
+                    "built_through",
+                ],
+                select(
+                    literal(benchmark_id),
+                    literal(period),
+                    period_start,
+                    func.count(ProcessedEmail.id),
+                    func.count(ProcessedEmail.id).filter(ProcessedEmail.stock_mentions),
+                    literal(cutoff, type_=DateTime),
+                )
+                .select_from(ProcessedEmail)
+                .join(Email, Email.filename == ProcessedEmail.email_id)
+                .where(
+                    ProcessedEmail.benchmark_id == benchmark_id,
+                    ProcessedEmail.processed_at <= cutoff,
+                    Email.date.is_not(None),
+                )
+                .group_by(period_start),
+            )
+        )
+        session.commit()
+
+    rows = session.exec(
+        select(
+            BenchmarkPeriodStat.period_start,
+            BenchmarkPeriodStat.emails,
+            BenchmarkPeriodStat.stock_emails,
+        )
+        .where(
+            BenchmarkPeriodStat.benchmark_id == benchmark_id,
+            BenchmarkPeriodStat.period == period,
+        )
+        .order_by(BenchmarkPeriodStat.period_start)
+    ).all()
+    return pd.DataFrame(rows, columns=["period_start", "emails", "stock_emails"])
+
+
+def price_frame(session: Session, period: str, volatility_window: int) -> pd.DataFrame:
+    """Stock prices per period with returns, volume changes and rolling volatility."""
+    _, freq, periods_per_year = ANALYSIS_PERIODS[period]
+    rows = session.exec(
+        select(
+            StockHistory.date,
+            StockHistory.close,
+            StockHistory.high,
+            StockHistory.low,
+            StockHistory.volume,
+        ).order_by(StockHistory.date)
+    ).all()
+    prices = pd.DataFrame(
+        rows, columns=["date", "close", "high", "low", "volume"]
+    ).set_index("date")
+
+    if period != "DAY":
+        # Bins start on the same boundary as date_trunc, e.g. Monday for weeks
+        prices = (
+            prices.resample(freq, label="left", closed="left")
+            .agg({"close": "last", "high": "max", "low": "min", "volume": "sum"})
+            .dropna(subset=["close"])
+        )
+
+    close = prices["close"].where(prices["close"] > 0)
+    log_close = np.log(close)
+    prices["return"] = close.pct_change()
+    prices["abs_return"] = prices["return"].abs()
+    prices["range"] = (prices["high"] - prices["low"]) / close
+    prices["volume_change"] = np.log(
+        prices["volume"].where(prices["volume"] > 0)
+    ).diff()
+    prices["volatility"] = log_close.diff().rolling(volatility_window).std() * np.sqrt(
+        periods_per_year
+    )
+    return prices.reset_index().rename(columns={"date": "price_date"})
+
+
+def join_prices(stats: pd.DataFrame, prices: pd.DataFrame, period: str) -> pd.DataFrame:
+    """As-of join discussion counts to the latest price at the start of each period.
+
+    Periods are laid out on a continuous calendar so that shifting by n rows is a
+    lag of n periods. Periods without trading keep the last close but have no
+    return or volume change.
+    """
+    _, freq, _ = ANALYSIS_PERIODS[period]
+    calendar = pd.DataFrame(
+        {
+            "period_start": pd.date_range(
+                stats["period_start"].min(), stats["period_start"].max(), freq=freq
+            )
+        }
+    )
+    frame = calendar.merge(stats, on="period_start", how="left")
+    frame[["emails", "stock_emails"]] = (
+        frame[["emails", "stock_emails"]].fillna(0).astype(int)
+    )
+    frame["rate"] = frame["stock_emails"] / frame["emails"].replace(0, np.nan)
+
+    frame = pd.merge_asof(
+        frame,
+        prices,
+        left_on="period_start",
+        right_on="price_date",
+        direction="backward",
+    )
+    stale = frame["price_date"] != frame["period_start"]
+    frame.loc[stale, ["return", "abs_return", "range", "volume_change"]] = np.nan
+    return frame
+
+
+def lagged_correlations(frame: pd.DataFrame, max_lag: int) -> pd.DataFrame:
+    """Correlation of the discussion rate with each market series at each lag.
+
+    A positive lag pairs discussion with the market that many periods later,
+    i.e. discussion leading the price.
+    """
+    return pd.DataFrame(
+        [
+            {
+                "lag": lag,
+                **{
+                    column: frame["rate"].corr(frame[column].shift(-lag))
+                    for column in MARKET_COLUMNS
+                },
+            }
+            for lag in range(-max_lag, max_lag + 1)
+        ]
+    )
+
+
+def event_windows(frame: pd.DataFrame, threshold: float, window: int) -> pd.DataFrame:
+    """Discussion rate in the periods around each large price move.
+
+    A large move is a return more than threshold standard deviations from the
+    mean. Each row is one event; offset columns hold the rate that many periods
+    before (negative) or after the move.
+    """
+    returns = frame["return"]
+    z_scores = ((returns - returns.mean()) / returns.std()).abs()
+    events = np.flatnonzero(z_scores.gt(threshold).to_numpy())
+
+    offsets = np.arange(-window, window + 1)
+    positions = events[:, None] + offsets[None, :]
+    in_range = (positions >= 0) & (positions < len(frame))
+    rates = frame["rate"].to_numpy()
+    matrix = np.where(in_range, rates[np.clip(positions, 0, len(frame) - 1)], np.nan)
+
+    result = pd.DataFrame(matrix, columns=offsets)
+    result.insert(0, "period_start", frame["period_start"].to_numpy()[events])
+    result.insert(1, "return", returns.to_numpy()[events])
+    return result
@@ -30,3 +30,19 @@ def llm_benchmark_count():
     engine = create_engine(DATABASE_URL)
     with Session(engine) as session:
         return session.exec(select(func.count(LLMBenchmark.id))).one()
+
+
+def benchmark_progress(benchmark_id: int):
+    """Return (processed, total, active workers) across every worker on a benchmark."""
+    engine = create_engine(DATABASE_URL)
+    with Session(engine) as session:
+        return session.exec(
+            select(
+                func.count(ProcessedEmail.processed_at),
+                func.count(ProcessedEmail.id),
+                func.count(func.distinct(ProcessedEmail.worker_id)).filter(
+                    ProcessedEmail.processed_at.is_(None),
+                    ProcessedEmail.lease_expires_at > func.now(),
+                ),
+            ).where(ProcessedEmail.benchmark_id == benchmark_id)
+        ).one()
@@ -0,0 +1,124 @@
+import threading
+from datetime import timedelta
+from sqlalchemy import Engine, Row, or_, update
+from sqlmodel import Session, select, func
+from domain.models import ProcessedEmail
+
+
+def claim_batch(
+    session: Session,
+    benchmark_id: int,
+    worker_id: str,
+    batch_size: int,
+    lease_seconds: int,
+) -> list[Row]:
+    """Claim up to batch_size pending entries for a worker.
+
+    Rows locked by another worker's claim transaction are skipped, and entries
+    whose lease has expired (a crashed or stuck worker) are claimed again.
+    Only the (id, email_id) of each claimed entry is returned.
+    """
+    entries = session.exec(
+        select(ProcessedEmail.id, ProcessedEmail.email_id)
+        .where(
+            ProcessedEmail.benchmark_id == benchmark_id,
+            ProcessedEmail.processed_at.is_(None),
+            or_(
+                ProcessedEmail.lease_expires_at.is_(None),
+                ProcessedEmail.lease_expires_at < func.now(),
+            ),
+        )
+        .order_by(ProcessedEmail.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+    if entries:
+        session.exec(
+            update(ProcessedEmail)
+            .where(ProcessedEmail.id.in_([entry.id for entry in entries]))
+            .values(
+                worker_id=worker_id,
+                lease_expires_at=func.now() + timedelta(seconds=lease_seconds),
+            )
+        )
+    session.commit()
+    return entries
+
+
+def renew_lease(session: Session, worker_id: str, lease_seconds: int) -> int:
+    """Extend the lease on every unfinished entry held by a worker."""
+    result = session.exec(
+        update(ProcessedEmail)
+        .where(
+            ProcessedEmail.worker_id == worker_id,
+            ProcessedEmail.processed_at.is_(None),
+        )
+        .values(lease_expires_at=func.now() + timedelta(seconds=lease_seconds))
+    )
+    session.commit()
+    return result.rowcount
+
+
+def hold_entry(
+    session: Session, entry_id: int, worker_id: str, lease_seconds: int
+) -> bool:
+    """Extend the lease on one entry, if the worker still holds it unfinished.
+
+    Returns False when the lease has expired and another worker has claimed the
+    entry since, or when it has already been processed.
+    """
+    result = session.exec(
+        update(ProcessedEmail)
+        .where(
+            ProcessedEmail.id == entry_id,
+            ProcessedEmail.worker_id == worker_id,
+            ProcessedEmail.processed_at.is_(None),
+        )
+        .values(lease_expires_at=func.now() + timedelta(seconds=lease_seconds))
+    )
+    session.commit()
+    return result.rowcount > 0
+
+
+def release_leases(session: Session, worker_id: str) -> int:
+    """Hand a worker's unfinished entries back to the queue."""
+    result = session.exec(
+        update(ProcessedEmail)
+        .where(
+            ProcessedEmail.worker_id == worker_id,
+            ProcessedEmail.processed_at.is_(None),
+        )
+        .values(worker_id=None, lease_expires_at=None)
+    )
+    session.commit()
+    return result.rowcount
+
+
+class Heartbeat(threading.Thread):
+    """Background thread renewing a worker's leases while it is running.
+
+    A single LLM call on a CPU box can take longer than a lease, so leases are
+    renewed on a timer instead of between emails. The worker stops the heartbeat
+    when it gives up, letting its leases expire.
+    """
+
+    def __init__(self, engine: Engine, worker_id: str, lease_seconds: int):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.interval = max(lease_seconds // 3, 1)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                with Session(self.engine) as session:
+                    renew_lease(session, self.worker_id, self.lease_seconds)
+            except Exception as e:
+                print(f"Heartbeat failed for worker {self.worker_id}: {e}")
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -11,9 +11,9 @@ def check_health():
         return False
 
 
-def check_ollama():
+def check_ollama(host: str = "http://host.docker.internal:11434"):
     try:
-        response = requests.get("http://host.docker.internal:11434")
+        response = requests.get(host)
         if response.status_code != 200:
             return False
         return True